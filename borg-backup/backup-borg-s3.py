@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 import os
+import re
+import json
+import functools
+import shutil
 import subprocess
 import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from pathlib import Path
 from dotenv import load_dotenv
 
 # Get environment variables from .env 
@@ -12,9 +21,12 @@ LOG_PATH = os.environ.get("LOG_PATH")
 LOG_LEVEL = os.environ.get("LOG_LEVEL")
 NUM_LOG_LEVEL = getattr(logging, LOG_LEVEL.upper(), None)
 
-logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(message)s', datefmt = '%m/%d/%Y %I:%M:%S %p', filename = LOG_PATH, level = NUM_LOG_LEVEL)
+logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(threadName)s - %(message)s', datefmt = '%m/%d/%Y %I:%M:%S %p', filename = LOG_PATH, level = NUM_LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
+# Reused across notifications to keep the connection to pushover alive
+SESSION = requests.Session()
+
 DOCKER_BACKUP_PREFIX = "docker-backup"
 ROUTER_BACKUP_PREFIX = "router-backup"
 PIHOLE_BACKUP_PREFIX = "pihole-backup"
@@ -26,63 +38,167 @@ ALL_PREFIXES = (DOCKER_BACKUP_PREFIX,
 CURRENT_TIME = datetime.now().strftime("%Y-%m-%dT%H.%M")
 PIHOLE_BACKUP_DIR="pi-hole-backup"
 ROUTER_BACKUP_DIR="openwrt-backup"
-ROUTER_TAR_NAME="openwrt.tar.gz"
 DEBUG=False
-
-ENV_VARS = (
-   "DOCKER_DIR",
-   "ROUTER_HOST",
-   "PIHOLE_HOST",
-   "SSH_PRIVATE_KEY_PATH",
-   "BORG_REPO",
-   "BORG_EXTDRIVE_REPO",
-   "BORG_S3_BACKUP_BUCKET",
-   "BORG_S3_BACKUP_AWS_PROFILE",
-   "PUSHOVER_URL",
-   "PUSHOVER_TOKEN",
-   "PUSHOVER_USER_TOKEN"
+# borg's default chunker: 2^21 (2 MiB) average chunks, fine for small config files.
+# Smaller chunks (e.g. buzhash,10,23,16,4095) dedup databases and images modified in place better,
+# at the cost of a larger chunks index.  Changing it makes the next backup store everything again.
+DEFAULT_CHUNKER_PARAMS="19,23,21,4095"
+SNAPSHOT_NAME="borg-snapshot"
+SNAPSHOT_MOUNT="/mnt/borg-snapshot"
+# Tries AES-GCM before the CTR modes, aes256 stays last for hosts offering nothing else
+SSH_OPTS=["-o", "Ciphers=chacha20-poly1305@openssh.com,aes128-gcm@openssh.com,aes128-ctr,aes256-ctr,aes256-gcm@openssh.com"]
+
+@dataclass(frozen=True)
+class Config:
+   """Settings read once from the environment"""
+   docker_dir: str
+   router_host: str
+   pihole_host: str
+   ssh_private_key_path: str
+   borg_repo: str
+   borg_passphrase: str
+   borg_extdrive_repo: str
+   borg_extdrive_passphrase: str
+   borg_compression: str
+   docker_chunker_params: str
+   skip_metadata: bool
+   snapshot_type: str
+   snapshot_volume: str
+   snapshot_volume_mount: str
+   snapshot_size: str
+   s3_bucket: str
+   s3_profile: str
+   backup_threshold: int
+   pushover_url: str
+   pushover_token: str
+   pushover_user_token: str
+
+CFG = Config(
+   docker_dir = os.environ.get("DOCKER_DIR"),
+   router_host = os.environ.get("ROUTER_HOST"),
+   pihole_host = os.environ.get("PIHOLE_HOST"),
+   ssh_private_key_path = os.environ.get("SSH_PRIVATE_KEY_PATH"),
+   borg_repo = os.environ.get("BORG_REPO"),
+   borg_passphrase = os.environ.get("BORG_PASSPHRASE"),
+   borg_extdrive_repo = os.environ.get("BORG_EXTDRIVE_REPO"),
+   borg_extdrive_passphrase = os.environ.get("BORG_EXTDRIVE_PASSPHRASE"),
+   borg_compression = os.environ.get("BORG_COMPRESSION", "auto,zstd,3"),
+   docker_chunker_params = os.environ.get("BORG_DOCKER_CHUNKER_PARAMS", DEFAULT_CHUNKER_PARAMS),
+   skip_metadata = os.environ.get("BORG_SKIP_METADATA", "false").lower() == "true",
+   snapshot_type = os.environ.get("BORG_SNAPSHOT_TYPE", ""),
+   snapshot_volume = os.environ.get("BORG_SNAPSHOT_VOLUME"),
+   snapshot_volume_mount = os.environ.get("BORG_SNAPSHOT_VOLUME_MOUNT"),
+   snapshot_size = os.environ.get("BORG_SNAPSHOT_SIZE", "5G"),
+   s3_bucket = os.environ.get("BORG_S3_BACKUP_BUCKET"),
+   s3_profile = os.environ.get("BORG_S3_BACKUP_AWS_PROFILE"),
+   backup_threshold = int(os.environ.get("BACKUP_THRESHOLD", 0)),
+   pushover_url = os.environ.get("PUSHOVER_URL"),
+   pushover_token = os.environ.get("PUSHOVER_TOKEN"),
+   pushover_user_token = os.environ.get("PUSHOVER_USER_TOKEN")
 )
 
+# Required .env variables and their loaded values
+ENV_VARS = {
+   "DOCKER_DIR": CFG.docker_dir,
+   "ROUTER_HOST": CFG.router_host,
+   "PIHOLE_HOST": CFG.pihole_host,
+   "SSH_PRIVATE_KEY_PATH": CFG.ssh_private_key_path,
+   "BORG_REPO": CFG.borg_repo,
+   "BORG_PASSPHRASE": CFG.borg_passphrase,
+   "BORG_EXTDRIVE_REPO": CFG.borg_extdrive_repo,
+   "BORG_EXTDRIVE_PASSPHRASE": CFG.borg_extdrive_passphrase,
+   "BORG_S3_BACKUP_BUCKET": CFG.s3_bucket,
+   "BORG_S3_BACKUP_AWS_PROFILE": CFG.s3_profile,
+   "PUSHOVER_URL": CFG.pushover_url,
+   "PUSHOVER_TOKEN": CFG.pushover_token,
+   "PUSHOVER_USER_TOKEN": CFG.pushover_user_token,
+   # Snapshot location is only needed when a snapshot type is set
+   **({
+      "BORG_SNAPSHOT_VOLUME": CFG.snapshot_volume,
+      "BORG_SNAPSHOT_VOLUME_MOUNT": CFG.snapshot_volume_mount
+   } if CFG.snapshot_type else {})
+}
+
 def main():
    """Backup all the goodies"""
    logger.info(f"Starting backup {CURRENT_TIME}")
 
    # Verify all required variables are set
-   for env_var in ENV_VARS:
-      if not os.environ.get(env_var):
+   for env_var, value in ENV_VARS.items():
+      if not value:
          logger.error(f"Please provide {env_var} in .env file")
          exit(1)
 
-   # Prepare backup directories
-   create_router_archive = not get_router_backup()
-   create_pihole_archive = not get_pihole_backup()
-
-   stop_docker()
-   
-   borg_repo = os.environ.get("BORG_REPO")
-   status = backup_to_repo(borg_repo = borg_repo,
-                  create_router_archive = create_router_archive,
-                  create_pihole_archive = create_pihole_archive)
+   # Prepare backup directories, router and pihole are independent hosts so fetch them concurrently
+   with ThreadPoolExecutor(max_workers = 2, thread_name_prefix = "fetch") as executor:
+      router_future = executor.submit(get_router_backup)
+      pihole_future = executor.submit(get_pihole_backup)
+      create_router_archive = not router_future.result()
+      create_pihole_archive = not pihole_future.result()
+
+   # Back up docker from a read-only snapshot when configured so containers keep running
+   snapshot_docker_dir = snapshot_home() if CFG.snapshot_type else ""
+   stopped_containers = []
+   if not snapshot_docker_dir:
+      stopped_containers = stop_docker()
+   docker_dir = snapshot_docker_dir or CFG.docker_dir
    
-   borg_info = ""
-   if status == 0:
-      prune_repo(borg_repo = borg_repo)
-      backup_to_aws(borg_repo)
-      borg_info = get_repo_info(borg_repo = borg_repo)
+   source_released = False
+   def release_source():
+      """Removes the snapshot or restarts docker, only once"""
+      nonlocal source_released
+      if source_released:
+         return
+      source_released = True
+      if snapshot_docker_dir:
+         destroy_snapshot()
+      else:
+         start_docker(stopped_containers)
+
+   # The source is released as soon as both repos are backed up, without waiting for pruning and the S3 sync
+   backups_left = 2
+   backups_lock = threading.Lock()
+   def backup_done():
+      """Called by each pipeline after its backup, the last one releases the source"""
+      nonlocal backups_left
+      with backups_lock:
+         backups_left -= 1
+         last = backups_left == 0
+      if last:
+         release_source()
+
+   borg_repo = CFG.borg_repo
+   borg_ext_repo = CFG.borg_extdrive_repo
+   try:
+      # NAS and external drive are different devices, run a backup and prune pipeline for each at once.
+      # The NAS pipeline also syncs to S3, overlapping the external drive backup.
+      with ThreadPoolExecutor(max_workers = 2, thread_name_prefix = "backup") as executor:
+         nas_future = executor.submit(backup_pipeline,
+                        borg_repo = borg_repo,
+                        passphrase = CFG.borg_passphrase,
+                        docker_dir = docker_dir,
+                        create_router_archive = create_router_archive,
+                        create_pihole_archive = create_pihole_archive,
+                        on_backup_done = backup_done,
+                        sync_to_aws = True)
+         ext_future = executor.submit(backup_pipeline,
+                        borg_repo = borg_ext_repo,
+                        passphrase = CFG.borg_extdrive_passphrase,
+                        docker_dir = docker_dir,
+                        create_router_archive = create_router_archive,
+                        create_pihole_archive = create_pihole_archive,
+                        on_backup_done = backup_done)
+         nas_status, nas_stats = nas_future.result()
+         ext_status, _ = ext_future.result()
+   finally:
+      # Never leave a snapshot behind or the containers stopped, even when a backup raised
+      release_source()
    
-   # # Change passphrase for next repo
-   os.environ['BORG_PASSPHRASE'] = os.environ.get("BORG_EXTDRIVE_PASSPHRASE")
-   borg_ext_repo = os.environ.get("BORG_EXTDRIVE_REPO")
-
-   status = backup_to_repo(borg_repo = borg_ext_repo,
-                  create_router_archive = create_router_archive,
-                  create_pihole_archive = create_pihole_archive)
-   if status == 0:
-      prune_repo(borg_repo = borg_ext_repo)
+   borg_info = format_stats(nas_stats)
 
    cleanup()
 
-   start_docker()
+   status = nas_status or ext_status
 
    aws_bucket_size = get_aws_bucket_size()
 
@@ -94,213 +210,345 @@ def main():
    else:
       send_notification(title="Backup failed", message=f"Exit code {status}")
 
+def borg_env(passphrase: str):
+   """Environment for a borg command, the passphrase is passed per call so repos can be used concurrently"""
+   # Only this host uses the repos, lets borg remove stale locks left by it (the default since borg 1.2)
+   return {**os.environ, "BORG_HOSTNAME_IS_UNIQUE": "yes", "BORG_PASSPHRASE": passphrase}
+
+@functools.lru_cache
+def load_excludes(excludes_file: str):
+   """Reads the exclude patterns once for all archives, skipping empty lines and comments like borg does"""
+   lines = (line.strip() for line in Path(excludes_file).read_text().splitlines())
+   return tuple(line for line in lines if line and not line.startswith("#"))
+
+def rebase_excludes(patterns: tuple, old_root: str, new_root: str):
+   """Points exclude patterns written for paths under old_root at the same paths under new_root"""
+   old_root = old_root.strip("/")
+   new_root = new_root.strip("/")
+   rebased = []
+   for pattern in patterns:
+      # Patterns may start with a borg style prefix such as fm: or sh:
+      style, path = (pattern[:3], pattern[3:]) if re.match(r"^[a-z]{2}:", pattern) else ("", pattern)
+      relative = path.lstrip("/")
+      if style == "re:":
+         if old_root in pattern:
+            logger.warning(f"Regex exclude {pattern} is not rewritten for the snapshot")
+      elif relative == old_root or relative.startswith(f"{old_root}/"):
+         pattern = f"{style}/{new_root}{relative[len(old_root):]}"
+      rebased.append(pattern)
+   return tuple(rebased)
+
 def borg_create(borg_repo: str, 
+           passphrase: str,
            backup_name: str, 
            backup_dir: str, 
-           excludes_file: str, 
+           excludes: tuple, 
+           chunker_params = DEFAULT_CHUNKER_PARAMS,
+           skip_metadata = False,
            dry_run = False):
-   """Creates a borg archive"""
+   """Creates a borg archive.  Failures are logged and reported through the result's returncode"""
    logger.info(f"Backing up {backup_dir} with borg to {borg_repo}::{backup_name}")
-   cmd = [
-      "borg create " +
-      ("--dry-run " if dry_run else "") +
-      f"{borg_repo}::{backup_name} " +
-      f"{backup_dir} " +
-      ("--stats " if not dry_run else "-v ") +
-      f"--exclude-from {excludes_file} " +
-      "--compression zlib,6"
-   ]
-   result = subprocess.run(cmd, check=True, shell=True)
-   logger.debug(result)
+   cmd = ["borg", "create"] + \
+         (["--dry-run"] if dry_run else []) + \
+         [f"{borg_repo}::{backup_name}", backup_dir] + \
+         (["--json"] if not dry_run else ["-v"]) + \
+         [arg for pattern in excludes for arg in ("--exclude", pattern)] + \
+         ["--compression", CFG.borg_compression,
+          "--chunker-params", chunker_params,
+          "--files-cache=mtime,size"] + \
+         (["--noflags", "--noacls", "--noxattrs"] if skip_metadata else [])
+   # Skip rereading unchanged files: ignore inode changes and keep cache entries for 200 backups
+   env = borg_env(passphrase)
+   env["BORG_FILES_CACHE_TTL"] = "200"
+   try:
+      result = subprocess.run(cmd, check=True, env=env, stdout=subprocess.PIPE, text=True)
+   except subprocess.CalledProcessError as error:
+      logger.error(error)
+      result = subprocess.CompletedProcess(error.cmd, error.returncode, error.stdout)
+   logger.debug("%r", result)
    return result
 
-def ssh(host: str, command: str):
-   """Runs a ssh command"""
+def ssh_extract(host: str, command: str, extract_dir: str, tar_options = "-xf"):
+   """Runs a ssh command and extracts the tar archive it writes to stdout into extract_dir.  Returns 0 when successful"""
    logger.info(f"Initiating ssh command: {host} {command}")
-   private_key_path = os.environ.get("SSH_PRIVATE_KEY_PATH")
+   os.makedirs(extract_dir, exist_ok = True)
 
-   return subprocess.run([f"ssh -i {private_key_path} {host} {command}"], check=not DEBUG, shell=True)
+   remote = subprocess.Popen(["ssh", *SSH_OPTS, "-i", CFG.ssh_private_key_path, host, command], stdout=subprocess.PIPE)
+   result = subprocess.run(["tar", tar_options, "-", "-C", extract_dir], stdin=remote.stdout)
+   remote.stdout.close()
+   logger.debug("%r", result)
 
-def scp(host: str, remote_path: str, local_path: str):
-   """Runs a scp command"""
-   private_key_path = os.environ.get("SSH_PRIVATE_KEY_PATH")
-   logger.info(f"Initiating scp command: {host}:{remote_path} {local_path}")
+   if remote.wait() or result.returncode:
+      logger.error(f"ssh exit code {remote.returncode}, tar exit code {result.returncode}")
+      return 1
 
-   return subprocess.run([f"scp -i {private_key_path} {host}:{remote_path} {local_path}"], check=not DEBUG, shell=True)
+   return 0
 
 def get_router_backup():
    """Retrieves /etc config files from router.  Returns 0 when successful"""
    logger.info("Retrieving Openwrt.lan backup")
 
-   router_host = os.environ.get("ROUTER_HOST")
-   user_and_host = f"root@{router_host}"
-
-   try:
-      result = ssh(user_and_host, f"tar -cvzf {ROUTER_TAR_NAME} /etc")
-      result = scp(user_and_host, ROUTER_TAR_NAME, ".")
-      result = ssh(user_and_host, f"rm -rf {ROUTER_TAR_NAME}")
-   except subprocess.CalledProcessError as error:
-      logger.debug(result)
-      send_notification(title="Error retrieving Openwrt.lan backup", message=error)
-      return 1;
-
-   os.mkdir(ROUTER_BACKUP_DIR)
-
-   result = subprocess.run(["tar", "xzvf", ROUTER_TAR_NAME, "-C", ROUTER_BACKUP_DIR])
-   logger.debug(result)
-   return result.returncode
-   
+   # Stream the archive straight into the local directory, nothing is written on the router.
+   # Left uncompressed as it is only extracted locally and borg compresses it afterwards.
+   if ssh_extract(f"root@{CFG.router_host}", "tar -cf - /etc", ROUTER_BACKUP_DIR):
+      send_notification(title="Error retrieving Openwrt.lan backup", message="ssh or tar failed, check the logs")
+      return 1
 
+   return 0
 
 def get_pihole_backup():
    """Retrieves /etc config files from pihole.  Returns 0 when successful"""
    logger.info("Retrieving Pi-Hole backup")
-   
-   pihole_host = os.environ.get("PIHOLE_HOST")
-   user_and_host = f"pi@{pihole_host}"
 
-   try:
-      result = ssh(user_and_host, "pihole -a -t")
-      result = scp(user_and_host, "pi-hole*", ".")
-      result = ssh(user_and_host, f"rm -rf pi-hole*")
-   except subprocess.CalledProcessError as error:
-      logger.debug(result)
-      send_notification(title="Error retrieving Pi-Hole backup", message=error)
+   # Teleporter can only write to a file, stream it back and remove it in the same connection.
+   # pihole re-runs itself as root, use a private directory: root can't open a pi-owned file in sticky /tmp
+   command = 'd=$(mktemp -d) && pihole -a -t "$d/teleporter.tar.gz" > /dev/null && cat "$d/teleporter.tar.gz"; status=$?; rm -rf "$d"; exit $status'
+   if ssh_extract(f"pi@{CFG.pihole_host}", command, PIHOLE_BACKUP_DIR, tar_options = "-xzf"):
+      send_notification(title="Error retrieving Pi-Hole backup", message="ssh or tar failed, check the logs")
       return 1
 
-   os.mkdir(PIHOLE_BACKUP_DIR)
-
-   result = subprocess.run([f"tar xzvf pi-hole-raspberrypi-teleporter* -C {PIHOLE_BACKUP_DIR}"], shell=True)
-   logger.debug(result)
-   return result.returncode
+   return 0
 
-
-def backup_to_repo(borg_repo: str, create_router_archive: bool, create_pihole_archive: bool):
+def backup_to_repo(borg_repo: str, passphrase: str, docker_dir: str, create_router_archive: bool, create_pihole_archive: bool):
    """Performs the backups to repo"""
    logger.info(f"Backing up to repo {borg_repo}")
-   excludes = "excludes.txt"
+   excludes = load_excludes("excludes.txt")
+   # Excludes are written for DOCKER_DIR, match the same files when backing up from a snapshot
+   docker_excludes = rebase_excludes(excludes, CFG.docker_dir, docker_dir) if docker_dir != CFG.docker_dir else excludes
+
+   # Each archive is its own borg invocation.  Consecutive runs reuse the local chunks cache, which is
+   # already in sync after the first one, and borg's python internals are not a supported API.
 
    # Docker
-   result = borg_create(
+   results = [borg_create(
       borg_repo = borg_repo,
+      passphrase = passphrase,
       backup_name = f"{DOCKER_BACKUP_PREFIX}-{CURRENT_TIME}",
-      backup_dir = os.environ.get("DOCKER_DIR"),
-      excludes_file = excludes,
-      dry_run = DEBUG)
+      backup_dir = docker_dir,
+      excludes = docker_excludes,
+      chunker_params = CFG.docker_chunker_params,
+      skip_metadata = CFG.skip_metadata,
+      dry_run = DEBUG)]
 
    # Router
    if create_router_archive:
-      result = borg_create(
+      results.append(borg_create(
          borg_repo = borg_repo,
+         passphrase = passphrase,
          backup_name = f"{ROUTER_BACKUP_PREFIX}-{CURRENT_TIME}",
          backup_dir = ROUTER_BACKUP_DIR,
-         excludes_file = excludes,
-         dry_run = DEBUG)
+         excludes = excludes,
+         skip_metadata = CFG.skip_metadata,
+         dry_run = DEBUG))
 
    # Pihole
    if create_pihole_archive:
-      result = borg_create(
+      results.append(borg_create(
          borg_repo = borg_repo,
+         passphrase = passphrase,
          backup_name = f"{PIHOLE_BACKUP_PREFIX}-{CURRENT_TIME}",
          backup_dir = PIHOLE_BACKUP_DIR,
-         excludes_file = excludes,
-         dry_run = DEBUG)
+         excludes = excludes,
+         skip_metadata = CFG.skip_metadata,
+         dry_run = DEBUG))
 
-   # /etc
-   result = borg_create(
+   # /etc, keeps flags, ACLs and xattrs
+   results.append(borg_create(
       borg_repo = borg_repo,
+      passphrase = passphrase,
       backup_name = f"{ETC_BACKUP_PREFIX}-{CURRENT_TIME}",
       backup_dir = "/etc",
-      excludes_file = excludes,
-      dry_run = DEBUG)
+      excludes = excludes,
+      dry_run = DEBUG))
    
-   return result.returncode
+   # borg create --json output, nothing is printed on dry runs or failures
+   stats = [json.loads(result.stdout) for result in results if result.stdout and not result.returncode]
+   return max(result.returncode for result in results), stats
+
+def backup_pipeline(borg_repo: str,
+                    passphrase: str,
+                    docker_dir: str,
+                    create_router_archive: bool,
+                    create_pihole_archive: bool,
+                    on_backup_done,
+                    sync_to_aws = False):
+   """Backs up to repo, then prunes it and syncs it to AWS if asked.  Returns the backup status and stats"""
+   try:
+      status, stats = backup_to_repo(borg_repo = borg_repo,
+                        passphrase = passphrase,
+                        docker_dir = docker_dir,
+                        create_router_archive = create_router_archive,
+                        create_pihole_archive = create_pihole_archive)
+   finally:
+      on_backup_done()
+
+   if status == 0:
+      prune_repo(borg_repo = borg_repo, passphrase = passphrase)
+      if sync_to_aws:
+         backup_to_aws(borg_repo, passphrase)
+
+   return status, stats
 
 def stop_docker():
-   """Stops all running docker containers"""
+   """Stops all running docker containers.  Returns the ids of the stopped containers"""
    logger.info("Stopping docker containers")
 
-   result = subprocess.run(["docker stop $(docker ps -a -q)"], shell=True)
-   logger.debug(result)
+   container_ids = subprocess.run(["docker", "ps", "-q"], capture_output=True, text=True).stdout.split()
+   if not container_ids:
+      logger.info("No running docker containers")
+      return []
+
+   result = subprocess.run(["docker", "stop", *container_ids])
+   logger.debug("%r", result)
+   return container_ids
 
-def start_docker():
-   """Starts all docker containers"""
+def start_docker(container_ids: list):
+   """Starts the docker containers stopped by stop_docker"""
    logger.info("Starting docker containers")
 
-   result = subprocess.run(["docker start $(docker ps -a -q)"], shell=True)
-   logger.debug(result)
+   if not container_ids:
+      logger.info("No docker containers to start")
+      return
+
+   result = subprocess.run(["docker", "start", *container_ids])
+   logger.debug("%r", result)
+
+def snapshot_home():
+   """Takes a read-only snapshot of the volume holding DOCKER_DIR.  Returns DOCKER_DIR inside the snapshot, empty on failure"""
+   logger.info(f"Creating {CFG.snapshot_type} snapshot of {CFG.snapshot_volume}")
+
+   # Outside the snapshot the relative path would point back to the live DOCKER_DIR
+   volume_mount = os.path.abspath(CFG.snapshot_volume_mount)
+   if os.path.commonpath([os.path.abspath(CFG.docker_dir), volume_mount]) != volume_mount:
+      logger.error(f"{CFG.docker_dir} is not under {CFG.snapshot_volume_mount}, stopping docker instead")
+      send_notification(title="Error creating snapshot, stopping docker instead",
+                        message=f"DOCKER_DIR {CFG.docker_dir} is not under BORG_SNAPSHOT_VOLUME_MOUNT {CFG.snapshot_volume_mount}")
+      return ""
+
+   if CFG.snapshot_type == "btrfs":
+      snapshot_root = os.path.join(CFG.snapshot_volume_mount, f".{SNAPSHOT_NAME}")
+      cmds = [["btrfs", "subvolume", "snapshot", "-r", CFG.snapshot_volume, snapshot_root]]
+   elif CFG.snapshot_type == "lvm":
+      snapshot_root = SNAPSHOT_MOUNT
+      os.makedirs(SNAPSHOT_MOUNT, exist_ok = True)
+      # XFS refuses to mount a snapshot next to its origin, both share the same filesystem UUID
+      fstype = subprocess.run(["findmnt", "-no", "FSTYPE", CFG.snapshot_volume_mount], capture_output=True, text=True).stdout.strip()
+      mount_options = "ro,nouuid" if fstype == "xfs" else "ro"
+      cmds = [["lvcreate", "--snapshot", "--name", SNAPSHOT_NAME, "--size", CFG.snapshot_size, CFG.snapshot_volume],
+              ["mount", "-o", mount_options, os.path.join(os.path.dirname(CFG.snapshot_volume), SNAPSHOT_NAME), SNAPSHOT_MOUNT]]
+   elif CFG.snapshot_type == "zfs":
+      snapshot_root = os.path.join(CFG.snapshot_volume_mount, ".zfs", "snapshot", SNAPSHOT_NAME)
+      cmds = [["zfs", "snapshot", f"{CFG.snapshot_volume}@{SNAPSHOT_NAME}"]]
+   else:
+      logger.error(f"Unknown snapshot type {CFG.snapshot_type}, use btrfs, lvm or zfs")
+      return ""
+
+   try:
+      for cmd in cmds:
+         result = subprocess.run(cmd, check=True)
+         logger.debug("%r", result)
+   except subprocess.CalledProcessError as error:
+      logger.error(error)
+      send_notification(title="Error creating snapshot, stopping docker instead", message=error)
+      destroy_snapshot()
+      return ""
+
+   return os.path.join(snapshot_root, os.path.relpath(CFG.docker_dir, CFG.snapshot_volume_mount))
+
+def destroy_snapshot():
+   """Removes the snapshot created by snapshot_home"""
+   logger.info(f"Removing {CFG.snapshot_type} snapshot of {CFG.snapshot_volume}")
+
+   if CFG.snapshot_type == "btrfs":
+      cmds = [["btrfs", "subvolume", "delete", os.path.join(CFG.snapshot_volume_mount, f".{SNAPSHOT_NAME}")]]
+   elif CFG.snapshot_type == "lvm":
+      cmds = [["umount", SNAPSHOT_MOUNT],
+              ["lvremove", "-f", os.path.join(os.path.dirname(CFG.snapshot_volume), SNAPSHOT_NAME)]]
+   elif CFG.snapshot_type == "zfs":
+      cmds = [["zfs", "destroy", f"{CFG.snapshot_volume}@{SNAPSHOT_NAME}"]]
+   else:
+      return
+
+   for cmd in cmds:
+      result = subprocess.run(cmd)
+      logger.debug("%r", result)
 
 def send_notification(title: str, message: str, priority = 0):
    """Sends notification to pushover"""
    logger.info("Sending notification to pushover")
-   pushover_url = os.environ.get("PUSHOVER_URL")
-   pushover_token = os.environ.get("PUSHOVER_TOKEN")
-   pushover_user_token = os.environ.get("PUSHOVER_USER_TOKEN")
 
-   cmd = [f"curl -s {pushover_url} " +
-          f"-F \"token={pushover_token}\" " +
-          f"-F \"user={pushover_user_token}\" " +
-          f"-F \"title={title}\" " +
-          f"-F \"message={message}\" " +
-          f"-F \"priority={priority}\""]
-   result = subprocess.run(cmd, shell=True)
-   logger.debug(result)
+   try:
+      response = SESSION.post(CFG.pushover_url, data = {
+         "token": CFG.pushover_token,
+         "user": CFG.pushover_user_token,
+         "title": title,
+         "message": str(message),
+         "priority": priority
+      }, timeout = 10)
+      logger.debug("%r", response)
+      response.raise_for_status()
+   except requests.RequestException as error:
+      logger.error(error)
 
-def prune_repo(borg_repo: str):
+def prune_repo(borg_repo: str, passphrase: str):
    """Prune old archives from borg repo"""
    logger.info(f"Pruning old backups from repo {borg_repo}")
 
+   # One prefix at a time: borg locks the repo exclusively, so concurrent prunes would only queue on the lock
    for prefix in ALL_PREFIXES:
-      result = subprocess.run([
-         f"borg prune -v -P {prefix} --list --keep-daily=1 --keep-weekly=1 --keep-monthly=1 {borg_repo}"
-      ], shell=True)
-      logger.debug(result)
-
-def get_repo_info(borg_repo: str, backup_name = "", json = False):
-   """Runs a borg info command"""
-   logger.info(f"Running borg info {borg_repo}")
-   result = subprocess.run(["borg info " + 
-                   ("--json " if json else "") + 
-                   borg_repo + 
-                   (f"::{backup_name}" if backup_name != "" else "")
-                   ], capture_output=True, text=True, shell=True)
-   logger.debug(result)
-   return result.stdout if not result.returncode else ""
-
-def get_backup_size(borg_repo: str, backup_name = ""):
+      result = subprocess.run(["borg", "prune", "-v", "-P", prefix, "--list",
+                               "--keep-daily=1", "--keep-weekly=1", "--keep-monthly=1", borg_repo],
+                              env=borg_env(passphrase))
+      logger.debug("%r", result)
+      if result.returncode:
+         logger.error(f"Pruning {prefix} from {borg_repo} failed with exit code {result.returncode}")
+
+def format_stats(stats: list):
+   """Formats borg create --json outputs for the notification"""
+   lines = [f"{stat['archive']['name']}: {stat['archive']['stats']['deduplicated_size']/1024/1024:.1f} MB added"
+            for stat in stats]
+   if stats:
+      repo_size = stats[-1]["cache"]["stats"]["unique_csize"]
+      lines.append(f"Repository size before pruning: {repo_size/1024/1024/1024:.3f} GB")
+   return "\n".join(lines)
+
+def get_backup_size(borg_repo: str, passphrase: str, backup_name = ""):
    """Gets backup size.  Total backup size if no backup_name specified"""
    logger.info(f"Getting borg backup size for: {borg_repo}" + (f"::{backup_name}" if backup_name != "" else ""))
    
-   result = subprocess.run([
-      f"borg info --json {borg_repo}" + (f"::{backup_name} " if backup_name != "" else " ") + "| " +
-      "jq .cache.stats.unique_csize | " +
-      "awk \'{ printf \"%d\", $1/1024/1024/1024; }\'"
-   ], capture_output=True, text=True, shell=True)
+   result = subprocess.run(["borg", "info", "--json",
+                            borg_repo + (f"::{backup_name}" if backup_name != "" else "")],
+                           capture_output=True, text=True, env=borg_env(passphrase))
+   logger.debug("%r", result)
+   if result.returncode:
+      return 0
 
-   logger.debug(result)
-   return int(result.stdout) if not result.returncode else 0
+   return json.loads(result.stdout)["cache"]["stats"]["unique_csize"] // (1024 ** 3)
 
-def backup_to_aws(borg_repo: str):
+def backup_to_aws(borg_repo: str, passphrase: str):
    """Syncs borg repo to AWS.  Returns 0 when successful"""
-   s3_bucket = os.environ.get("BORG_S3_BACKUP_BUCKET")
-   s3_profile = os.environ.get("BORG_S3_BACKUP_AWS_PROFILE")
-   backup_threshold = int(os.environ.get("BACKUP_THRESHOLD", 0))
+   s3_bucket = CFG.s3_bucket
+   s3_profile = CFG.s3_profile
+   backup_threshold = CFG.backup_threshold
 
    if(backup_threshold > 0 ):
-      backup_size = int(get_backup_size(borg_repo))
+      backup_size = int(get_backup_size(borg_repo, passphrase))
       if(backup_size > backup_threshold):
          msg = f"Backup size {backup_size} GB is larger than threshold {backup_threshold} GB"
          logger.error(msg)
          send_notification(title="Backup Threshold", message=msg)
          return 1;
 
-   logger.info(f"Syncing to s3 bucket {s3_bucket}")
+   # s5cmd uploads segments in parallel, fall back to the aws cli when it is not installed
+   if shutil.which("s5cmd"):
+      sync_cmd = ["s5cmd", f"--profile={s3_profile}", "sync", "--delete", f"{borg_repo}/", f"s3://{s3_bucket}/"]
+   else:
+      sync_cmd = ["aws", "s3", "sync", borg_repo, f"s3://{s3_bucket}", f"--profile={s3_profile}", "--delete"]
+
+   logger.info(f"Syncing to s3 bucket {s3_bucket} with {sync_cmd[0]}")
    try:
-      result = subprocess.run([
-         f"borg with-lock {borg_repo} " +
-         f"aws s3 sync {borg_repo} s3://{s3_bucket} --profile={s3_profile} --delete"
-      ], check=True, shell=True)
-      logger.debug(result)
+      result = subprocess.run(["borg", "with-lock", borg_repo, *sync_cmd], check=True, env=borg_env(passphrase))
+      logger.debug("%r", result)
       return 0
    except subprocess.CalledProcessError as error:
       logger.error(error)
@@ -308,29 +556,37 @@ def backup_to_aws(borg_repo: str):
       return 1;
 
 def get_aws_bucket_size():
-   """Syncs borg repo to AWS.  Returns 0 when successful"""
-   s3_bucket = os.environ.get("BORG_S3_BACKUP_BUCKET")
-   s3_profile = os.environ.get("BORG_S3_BACKUP_AWS_PROFILE")
+   """Gets AWS bucket size in GB.  Returns empty string on failure"""
+   s3_bucket = CFG.s3_bucket
+   s3_profile = CFG.s3_profile
 
    logger.info(f"Getting aws bucket size {s3_bucket}")
    try:
-      result = subprocess.run([
-         f"aws s3 ls --profile={s3_profile} --summarize --recursive s3://{s3_bucket} | " +
-         "tail -1 | " +
-         "awk '{ printf \"%.3f GB\", $3/1024/1024/1024; }'"
-      ], capture_output=True, check=True, text=True, shell=True)
-      logger.debug(result)
-      return result.stdout if not result.returncode else ""
+      result = subprocess.run(["aws", "s3", "ls", f"--profile={s3_profile}", "--summarize", "--recursive", f"s3://{s3_bucket}"],
+                              capture_output=True, check=True, text=True)
+      logger.debug("%r", result)
    except subprocess.CalledProcessError as error:
       logger.error(error)
-      return "";
+      return ""
+
+   total_size = re.search(r"Total Size: (\d+)", result.stdout)
+   if not total_size:
+      logger.error("Total size not found in aws s3 ls summary")
+      return ""
+
+   return f"{int(total_size.group(1))/1024/1024/1024:.3f} GB"
 
 def cleanup():
    """Cleans up directory"""
    logger.info("Cleanup")
 
-   logger.debug(subprocess.run(["rm -rf openwrt*"], shell=True))
-   logger.debug(subprocess.run(["rm -rf pi-hole*"], shell=True))
+   for pattern in ("openwrt*", "pi-hole*"):
+      for path in Path.cwd().glob(pattern):
+         logger.debug("Removing %s", path)
+         if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path, ignore_errors = True)
+         else:
+            path.unlink(missing_ok = True)
 
 if __name__ == "__main__":
    main()
\ No newline at end of file
@@ -80,7 +80,10 @@ fi
 
 # Stopping docker containers to ensure uncorrupted files
 printf "\n** Stopping docker containers..."
-docker stop $(docker ps -a -q)
+RUNNING_CONTAINERS=$(docker ps -q)
+if [[ "$RUNNING_CONTAINERS" ]]; then
+	docker stop ${RUNNING_CONTAINERS}
+fi
 
 # Docker borg backup
 printf "\n** Backing up ${DOCKER_DIR} with borg to repo ${BORG_REPO}..."
@@ -285,7 +288,10 @@ fi
 
 # Stopping docker containers to ensure uncorrupted files
 printf "\n\n** Starting docker containers..."
-docker start $(docker ps -a -q)
+# Only restart the containers stopped above
+if [[ "$RUNNING_CONTAINERS" ]]; then
+	docker start ${RUNNING_CONTAINERS}
+fi
 
 # Send Pushover notification and exit appropriately
 printf "\n** Sending notification to pushover..."